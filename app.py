@@ -1,10 +1,21 @@
 import streamlit as st
 import os
-import time
+import io
 import json
+import hashlib
+import sqlite3
+import asyncio
+import threading
+import queue
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
+from urllib.parse import quote_plus
 from datetime import datetime, timedelta, timezone
-from openai import AzureOpenAI
+from openai import APIError, AzureOpenAI, AsyncAzureOpenAI, AsyncAssistantEventHandler
 from dotenv import load_dotenv
 
 # 1. 환경 설정
@@ -22,94 +33,291 @@ if not api_key or not endpoint:
     st.error("API 키가 설정되지 않았습니다.")
     st.stop()
 
+API_VERSION = "2024-05-01-preview"
+
 client = AzureOpenAI(
     api_key=api_key,
-    api_version="2024-05-01-preview",
+    api_version=API_VERSION,
     azure_endpoint=endpoint
 )
 
 # ---------------------------------------------------------
 # 2. 도구 함수 정의
 # ---------------------------------------------------------
+# 동시에 실행되는 도구 호출이 커넥션을 재사용하도록 세션 공유 (rerun 간에도 유지되도록 캐시)
+@st.cache_resource
+def get_weather_session():
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=Retry(total=2, backoff_factor=0.2)))
+    return session
+
+MAX_DOWNLOAD_WORKERS = 8
+
+# 도시 이름은 URL 인코딩 (예: "New York")
+def _weather_url(location):
+    return f"https://api.openweathermap.org/data/2.5/weather?q={quote_plus(location)}&appid={weather_key}&units=metric"
+
+# 날씨/시간 조회가 같은 도시를 물으면 5분간 메모리에서 재사용
+# 실패(타임아웃, 429/5xx 등)는 예외로 빠져나가 캐시에 남지 않음
+@st.cache_data(ttl=300, show_spinner=False)
+def _fetch_location_data(location):
+    response = get_weather_session().get(_weather_url(location), timeout=(2, 4))
+    response.raise_for_status()
+    return response.json()
+
 def get_location_data(location):
     if not weather_key: return None
-    url = f"http://api.openweathermap.org/data/2.5/weather?q={location}&appid={weather_key}&units=metric"
     try:
-        response = requests.get(url)
-        return response.json() if response.status_code == 200 else None
-    except: return None
+        return _fetch_location_data(location)
+    except requests.RequestException: return None
 
 def get_current_weather(location):
     data = get_location_data(location)
     if data:
-        return json.dumps({
+        return orjson.dumps({
             "location": location, "temperature": round(data["main"]["temp"], 1),
             "unit": "celsius", "description": data["weather"][0]["description"]
-        })
-    return json.dumps({"error": "City not found"})
+        }).decode("utf-8")
+    return orjson.dumps({"error": "City not found"}).decode("utf-8")
 
 def get_current_time(location):
     data = get_location_data(location)
     if data:
         local_time = datetime.now(timezone.utc) + timedelta(seconds=data["timezone"])
-        return json.dumps({"location": location, "current_time": local_time.strftime("%Y-%m-%d %I:%M %p")})
-    return json.dumps({"error": "City not found"})
+        return orjson.dumps({"location": location, "current_time": local_time.strftime("%Y-%m-%d %I:%M %p")}).decode("utf-8")
+    return orjson.dumps({"error": "City not found"}).decode("utf-8")
+
+def dispatch_tool(tool):
+    func_name = tool.function.name
+    args = orjson.loads(tool.function.arguments)
+
+    if func_name == "get_current_weather":
+        output = get_current_weather(args["location"])
+    elif func_name == "get_current_time":
+        output = get_current_time(args["location"])
+    else: output = "{}"
+    return {"tool_call_id": tool.id, "output": output}
+
+# 결과 이미지/파일은 file_id로만 보관하고 바이트는 캐시에서 로드
+# 기록 재생(최근 50개 메시지 × 여러 첨부)보다 넉넉하게 잡아야 rerun마다 다시 받지 않음
+@st.cache_data(max_entries=512, ttl=3600, show_spinner=False)
+def load_asset(file_id):
+    return client.files.content(file_id).read()
+
+def load_asset_or_none(file_id):
+    # 삭제되었거나 받을 수 없는 파일 하나 때문에 대화 화면 전체가 깨지지 않도록 처리
+    try:
+        return load_asset(file_id)
+    except APIError: return None
+
+def render_image(file_id):
+    data = load_asset_or_none(file_id)
+    if data: st.image(data)
+    else: st.caption("⚠️ 이미지를 불러올 수 없습니다.")
+
+def render_download(file_name, file_id):
+    data = load_asset_or_none(file_id)
+    if data: st.download_button(label=f"📂 {file_name} 다운로드", data=data, file_name=file_name)
+    else: st.caption(f"⚠️ {file_name} 파일을 불러올 수 없습니다.")
+
+# 같은 내용의 파일은 한 번만 업로드 (digest로 캐시, _data는 해시 대상에서 제외)
+@st.cache_resource(show_spinner=False)
+def upload_once(digest, name, _data):
+    return client.files.create(file=(name, io.BytesIO(_data)), purpose="assistants").id
+
+# 업로드를 백그라운드에서 처리하는 실행기 (rerun마다 새로 만들지 않도록 캐시)
+@st.cache_resource
+def get_upload_executor():
+    return ThreadPoolExecutor(max_workers=2)
+
+# ---------------------------------------------------------
+# 3. 스트리밍 이벤트 핸들러
+# ---------------------------------------------------------
+# 이벤트 루프 스레드에서는 화면을 직접 건드리지 않고 events 큐로 넘겨
+# 스크립트 스레드가 그리도록 함 (Streamlit 요소는 스크립트 스레드에서만 안전)
+class EventHandler(AsyncAssistantEventHandler):
+    def __init__(self, aclient, events, buffer=""):
+        super().__init__()
+        self.aclient = aclient
+        self.events = events
+        self.buffer = buffer
+        self.final_message = None
+
+    async def on_text_delta(self, delta, snapshot):
+        # 토큰이 도착하는 즉시 화면에 반영
+        self.buffer += delta.value or ""
+        self.events.put(("text", self.buffer))
+
+    async def on_message_done(self, message):
+        # 완료된 메시지를 보관해 messages.list 재조회를 생략
+        self.final_message = message
+
+    async def on_tool_call_created(self, tool_call):
+        if tool_call.type == "code_interpreter":
+            self.events.put(("status", " -> 코드 실행 중..."))
+        elif tool_call.type == "file_search":
+            self.events.put(("status", " -> 파일 검색 중..."))
+
+    async def on_event(self, event):
+        if event.event == "thread.run.requires_action":
+            await self.handle_requires_action(event.data)
+        elif event.event in ["thread.run.failed", "thread.run.cancelled", "thread.run.expired"]:
+            self.events.put(("error", "오류 발생"))
+
+    async def handle_requires_action(self, run):
+        tool_calls = run.required_action.submit_tool_outputs.tool_calls
+        for tool in tool_calls:
+            args = orjson.loads(tool.function.arguments)
+            if tool.function.name == "get_current_weather":
+                self.events.put(("status", f" -> 날씨 조회: {args['location']}"))
+            elif tool.function.name == "get_current_time":
+                self.events.put(("status", f" -> 시간 조회: {args['location']}"))
+
+        # 여러 도구 호출의 네트워크 대기를 겹쳐서 처리 (도구 함수는 동기라 스레드에서 실행)
+        tool_outputs = await asyncio.gather(*(asyncio.to_thread(dispatch_tool, tool) for tool in tool_calls))
+
+        # 도구 결과 제출 후 이어지는 응답도 같은 화면에 스트리밍
+        handler = EventHandler(self.aclient, self.events, self.buffer)
+        async with self.aclient.beta.threads.runs.submit_tool_outputs_stream(
+            thread_id=run.thread_id,
+            run_id=run.id,
+            tool_outputs=list(tool_outputs),
+            event_handler=handler,
+        ) as stream:
+            await stream.until_done()
+        self.buffer = handler.buffer
+        if handler.final_message:
+            self.final_message = handler.final_message
+
+# 비동기 클라이언트는 이벤트 루프에 묶이므로, 루프 스레드 하나와 클라이언트 하나를
+# 계속 유지해야 턴 사이에 Azure 커넥션이 재사용됨
+@st.cache_resource
+def get_async_runtime():
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    aclient = AsyncAzureOpenAI(api_key=api_key, api_version=API_VERSION, azure_endpoint=endpoint)
+    return loop, aclient
+
+async def run_turn(aclient, thread_id, assistant_id, events):
+    try:
+        handler = EventHandler(aclient, events)
+        async with aclient.beta.threads.runs.stream(
+            thread_id=thread_id,
+            assistant_id=assistant_id,
+            event_handler=handler,
+        ) as stream:
+            await stream.until_done()
+        return handler.final_message
+    finally:
+        events.put(None)
 
 # ---------------------------------------------------------
-# 3. Assistant & Thread 초기화
+# 4. Assistant & Thread 초기화
 # ---------------------------------------------------------
+# 지시문이나 도구 구성을 바꾸면 버전 태그도 올려야 새 Assistant가 생성됨
+ASSISTANT_NAME = "Streamlit Multi-Modal Bot v3"
+
+_TOOLS_SPEC = [
+    {"type": "code_interpreter"},
+    {"type": "file_search"},
+    {"type": "function", "function": {"name": "get_current_weather", "description": "Get current weather.", "parameters": {"type": "object", "properties": {"location": {"type": "string"}}, "required": ["location"]}}},
+    {"type": "function", "function": {"name": "get_current_time", "description": "Get current local time.", "parameters": {"type": "object", "properties": {"location": {"type": "string"}}, "required": ["location"]}}}
+]
+
 @st.cache_resource
 def create_assistant():
+    # 컨테이너가 재시작되어도 기존 Assistant를 재사용
+    for a in client.beta.assistants.list(limit=100).data:
+        if a.name == ASSISTANT_NAME: return a
+
     assistant = client.beta.assistants.create(
-        name="Streamlit Multi-Modal Bot",
+        name=ASSISTANT_NAME,
         instructions="당신은 데이터 전문가이자 비전 능력을 가진 AI입니다. 이미지가 주어지면 내용을 설명하고, 데이터 파일이 주어지면 분석하세요.",
         model="gpt-4o-mini", 
-        tools=[
-            {"type": "code_interpreter"}, 
-            {"type": "file_search"},
-            {"type": "function", "function": {"name": "get_current_weather", "description": "Get current weather.", "parameters": {"type": "object", "properties": {"location": {"type": "string"}}, "required": ["location"]}}},
-            {"type": "function", "function": {"name": "get_current_time", "description": "Get current local time.", "parameters": {"type": "object", "properties": {"location": {"type": "string"}}, "required": ["location"]}}}
-        ],
+        tools=_TOOLS_SPEC,
     )
     return assistant
 
+# 대화 기록은 session_state 대신 SQLite에 thread_id 단위로 저장
+HISTORY_DB = ".chat_cache.db"
+HISTORY_LIMIT = 50
+HISTORY_MAX_ROWS = 5000
+
+@st.cache_resource
+def get_history_db():
+    # 모든 세션 스레드가 연결 하나를 공유하므로 접근은 lock으로 직렬화
+    conn = sqlite3.connect(HISTORY_DB, check_same_thread=False)
+    conn.execute("CREATE TABLE IF NOT EXISTS msg (thread_id TEXT, role TEXT, content TEXT)")
+    return conn, threading.Lock()
+
+def save_message(thread_id, msg):
+    conn, lock = get_history_db()
+    with lock, conn:
+        conn.execute("INSERT INTO msg VALUES (?,?,?)", (thread_id, msg["role"], json.dumps(msg, ensure_ascii=False)))
+        # 끝난 세션의 기록이 쌓이지 않도록 최근 HISTORY_MAX_ROWS개만 유지
+        conn.execute("DELETE FROM msg WHERE rowid <= (SELECT MAX(rowid) FROM msg) - ?", (HISTORY_MAX_ROWS,))
+
+def load_messages(thread_id, limit=HISTORY_LIMIT):
+    # 최근 limit개만 꺼내서 오래된 순으로 반환
+    conn, lock = get_history_db()
+    with lock:
+        rows = conn.execute(
+            "SELECT content FROM msg WHERE thread_id = ? ORDER BY rowid DESC LIMIT ?", (thread_id, limit)
+        ).fetchall()
+    return [json.loads(row[0]) for row in reversed(rows)]
+
 if "assistant" not in st.session_state:
     st.session_state.assistant = create_assistant()
     st.session_state.thread = client.beta.threads.create()
-    st.session_state.messages = [] 
 
 # ---------------------------------------------------------
-# 4. 사이드바: 파일 업로드 UI
+# 5. 사이드바: 파일 업로드 UI
 # ---------------------------------------------------------
 with st.sidebar:
     st.header("📂 파일 업로드")
     uploaded_file = st.file_uploader("이미지나 문서를 올리세요", type=["txt", "csv", "xlsx", "pdf", "png", "jpg", "jpeg", "gif"])
     st.info("💡 파일을 올린 후 채팅창에 질문을 입력하세요.")
 
+    # 파일을 고르는 즉시 업로드를 시작해 질문 입력 시간과 겹치게 함
+    if uploaded_file and uploaded_file.file_id != st.session_state.get("last_uploaded_id"):
+        file_data = uploaded_file.getvalue()
+        digest = hashlib.blake2b(file_data, digest_size=16).hexdigest()
+        st.session_state.upload_future = get_upload_executor().submit(upload_once, digest, uploaded_file.name, file_data)
+        st.session_state.last_uploaded_id = uploaded_file.file_id
+
 # ---------------------------------------------------------
-# 5. 채팅 인터페이스
+# 6. 채팅 인터페이스
 # ---------------------------------------------------------
-for msg in st.session_state.messages:
-    with st.chat_message(msg["role"]):
-        # 텍스트가 리스트(멀티모달)일 수도 있고 문자열일 수도 있음
-        if isinstance(msg["content"], list):
-            for content_part in msg["content"]:
-                if content_part["type"] == "text":
-                    st.markdown(content_part["text"])
-        else:
-            st.markdown(msg["content"])
-            
-        if "images" in msg:
-            for img_data in msg["images"]:
-                st.image(img_data)
-        if "files" in msg:
-            for f_name, f_data in msg["files"]:
-                st.download_button(label=f"📂 {f_name} 다운로드", data=f_data, file_name=f_name)
+def message_text(msg):
+    # 텍스트가 리스트(멀티모달)일 수도 있고 문자열일 수도 있음
+    if isinstance(msg["content"], list):
+        return "\n\n".join(p["text"] for p in msg["content"] if p["type"] == "text")
+    return msg["content"]
+
+def has_body(msg):
+    return msg["content"] or msg.get("image_file_ids") or msg.get("download_refs")
+
+# 같은 역할의 연속된 메시지는 하나의 chat_message로 묶어서 렌더링
+# (빈 메시지는 먼저 걸러야 그 앞뒤의 같은 역할 메시지가 한 묶음이 됨)
+for role, group in groupby(filter(has_body, load_messages(st.session_state.thread.id)), key=lambda m: m["role"]):
+    with st.chat_message(role):
+        # 텍스트만 있는 메시지는 모아서 한 번에 출력하고, 첨부가 있으면 해당 텍스트 바로 뒤에 붙임
+        texts = []
+        for msg in group:
+            text = message_text(msg)
+            if text: texts.append(text)
+            if msg.get("image_file_ids") or msg.get("download_refs"):
+                if texts: st.markdown("\n\n---\n\n".join(texts))
+                texts = []
+                for f_id in msg.get("image_file_ids", []):
+                    render_image(f_id)
+                for f_name, f_id in msg.get("download_refs", []):
+                    render_download(f_name, f_id)
+        if texts: st.markdown("\n\n---\n\n".join(texts))
 
 if prompt := st.chat_input("메시지를 입력하세요..."):
     # 1. 사용자 메시지 표시
     st.chat_message("user").markdown(prompt)
-    st.session_state.messages.append({"role": "user", "content": prompt})
 
     # 2. 파일 처리 로직 (이미지 vs 문서 분기 처리)
     msg_content = prompt
@@ -117,11 +325,14 @@ if prompt := st.chat_input("메시지를 입력하세요..."):
 
     if uploaded_file:
         with st.spinner("파일 업로드 및 처리 중..."):
-            file_response = client.files.create(
-                file=uploaded_file,
-                purpose="assistants"
-            )
-            file_id = file_response.id
+            try:
+                file_id = st.session_state.upload_future.result()
+            except APIError:
+                # 실패한 future를 버려서 다음 실행 때 업로드를 다시 시도
+                st.session_state.pop("upload_future", None)
+                st.session_state.pop("last_uploaded_id", None)
+                st.error("파일 업로드에 실패했습니다. 다시 시도해 주세요.")
+                st.stop()
             file_ext = os.path.splitext(uploaded_file.name)[1].lower()
 
             # [이미지 파일] -> Vision (Content에 포함)
@@ -143,6 +354,7 @@ if prompt := st.chat_input("메시지를 입력하세요..."):
                 st.toast(f"📄 문서 분석 모드: {uploaded_file.name}")
 
     # 3. 메시지 전송
+    save_message(st.session_state.thread.id, {"role": "user", "content": prompt})
     client.beta.threads.messages.create(
         thread_id=st.session_state.thread.id,
         role="user",
@@ -150,72 +362,54 @@ if prompt := st.chat_input("메시지를 입력하세요..."):
         attachments=msg_attachments
     )
 
-    # 4. 실행 및 폴링
+    # 4. 실행 및 스트리밍
     with st.chat_message("assistant"):
         status_box = st.status("AI가 처리 중입니다...", expanded=True)
-        
-        run = client.beta.threads.runs.create(thread_id=st.session_state.thread.id, assistant_id=st.session_state.assistant.id)
-        
-        while True:
-            run_status = client.beta.threads.runs.retrieve(thread_id=st.session_state.thread.id, run_id=run.id)
-            
-            if run_status.status == 'completed':
-                break
-            elif run_status.status == 'requires_action':
-                tool_calls = run_status.required_action.submit_tool_outputs.tool_calls
-                tool_outputs = []
-                for tool in tool_calls:
-                    func_name = tool.function.name
-                    args = json.loads(tool.function.arguments)
-                    
-                    if func_name == "get_current_weather":
-                        output = get_current_weather(args["location"])
-                        status_box.write(f" -> 날씨 조회: {args['location']}")
-                    elif func_name == "get_current_time":
-                        output = get_current_time(args["location"])
-                        status_box.write(f" -> 시간 조회: {args['location']}")
-                    else: output = "{}"
-                    tool_outputs.append({"tool_call_id": tool.id, "output": output})
-                
-                client.beta.threads.runs.submit_tool_outputs(thread_id=st.session_state.thread.id, run_id=run.id, tool_outputs=tool_outputs)
-            elif run_status.status in ['failed', 'cancelled', 'expired']:
-                st.error("오류 발생")
-                break
-            time.sleep(1)
+        placeholder = st.empty()
+
+        loop, aclient = get_async_runtime()
+        events = queue.Queue()
+        future = asyncio.run_coroutine_threadsafe(
+            run_turn(aclient, st.session_state.thread.id, st.session_state.assistant.id, events), loop
+        )
+
+        # 루프 스레드가 보낸 이벤트를 스크립트 스레드에서 화면에 반영
+        while (event := events.get()) is not None:
+            kind, value = event
+            if kind == "text": placeholder.markdown(value)
+            elif kind == "status": status_box.write(value)
+            elif kind == "error": st.error(value)
+        latest_msg = future.result()
         
         status_box.update(label="답변 완료!", state="complete", expanded=False)
 
         # 5. 결과 처리
-        messages = client.beta.threads.messages.list(thread_id=st.session_state.thread.id)
-        latest_msg = messages.data[0]
-        
-        response_txt = ""
-        images_to_show = []
-        files_to_download = []
+        txt_parts, image_ids, file_annotations = [], [], []
 
-        for content in latest_msg.content:
+        # 1차: 텍스트와 다운로드할 파일 목록을 한 번에 수집
+        for content in (latest_msg.content if latest_msg else []):
             if content.type == 'text':
-                response_txt += content.text.value
-                if content.text.annotations:
-                    for annotation in content.text.annotations:
-                        if annotation.type == 'file_path':
-                            file_id = annotation.file_path.file_id
-                            file_name = os.path.basename(annotation.text)
-                            file_data = client.files.content(file_id).read()
-                            files_to_download.append((file_name, file_data))
+                txt_parts.append(content.text.value)
+                file_annotations.extend(a for a in (content.text.annotations or ()) if a.type == 'file_path')
             elif content.type == 'image_file':
-                file_id = content.image_file.file_id
-                image_data = client.files.content(file_id).read()
-                images_to_show.append(image_data)
+                image_ids.append(content.image_file.file_id)
+        response_txt = "".join(txt_parts)
+        file_refs = [(os.path.basename(a.text), a.file_path.file_id) for a in file_annotations]
+
+        # 2차: 이미지/파일 동시 다운로드 (load_asset 캐시 채우기)
+        file_ids = image_ids + [f_id for _, f_id in file_refs]
+        if file_ids:
+            with ThreadPoolExecutor(max_workers=min(len(file_ids), MAX_DOWNLOAD_WORKERS)) as ex:
+                list(ex.map(load_asset_or_none, file_ids))
 
-        st.markdown(response_txt)
-        for img_data in images_to_show: st.image(img_data)
-        for f_name, f_data in files_to_download:
-            st.download_button(label=f"📂 {f_name} 다운로드", data=f_data, file_name=f_name)
+        # 3차: 화면 표시
+        placeholder.markdown(response_txt)
+        for f_id in image_ids: render_image(f_id)
+        for f_name, f_id in file_refs: render_download(f_name, f_id)
 
-        st.session_state.messages.append({
+        save_message(st.session_state.thread.id, {
             "role": "assistant", 
             "content": response_txt,
-            "images": images_to_show,
-            "files": files_to_download
+            "image_file_ids": image_ids,
+            "download_refs": file_refs
         })